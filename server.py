@@ -3,22 +3,68 @@ FastAPI Server for ParcelAm using Pinecone Assistant
 Replaces the previous custom RAG implementation
 """
 
+import asyncio
+import hashlib
+import logging
+import logging.handlers
 import os
-from fastapi import FastAPI, HTTPException
+import queue
+import re
+import threading
+from contextlib import asynccontextmanager
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
 from pydantic import BaseModel
-from typing import List, Dict, Optional
-import requests
+from cachetools import TTLCache
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+from typing import List, Dict
+import msgspec
+import orjson
 from pinecone import Pinecone
+from pinecone_plugins.assistant.models.chat import Message
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Run the background log listener and warm the assistant per worker"""
+    # Hand log records to a listener thread so requests never block on IO
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(
+        "%(asctime)s %(levelname)s %(name)s %(message)s"
+    ))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    logger.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+    logger.propagate = False
+    try:
+        # Resolve the assistant up front so the first query skips the handshake
+        try:
+            await _get_assistant(ASSISTANT_NAME)
+        except Exception:
+            logger.warning("Assistant warm-up failed; resolving on first request", exc_info=True)
+        yield
+    finally:
+        # Flush queued log records before the worker exits
+        listener.stop()
+
+
 app = FastAPI(
     title="ParcelAm Assistant API",
     description="Pinecone Assistant API for ParcelAm customer support",
-    version="2.0.0"
+    version="2.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # Enable CORS
@@ -30,26 +76,187 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize Pinecone
-pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
+# Initialize Pinecone; ask for gzip so large answers and snippets compress on the wire
+pc = Pinecone(
+    api_key=os.getenv("PINECONE_API_KEY"),
+    additional_headers={"Accept-Encoding": "gzip"}
+)
 
 # Configure Assistant
 ASSISTANT_NAME = "parcel-assistant"
 ASSISTANT_HOST = "https://prod-1-data.ke.pinecone.io/assistant"  # Fixed host
 
+# Answer cache: support questions repeat heavily across users
+QUERY_CACHE_MAXSIZE = 10_000
+QUERY_CACHE_TTL = 900  # seconds
+_query_cache = TTLCache(maxsize=QUERY_CACHE_MAXSIZE, ttl=QUERY_CACHE_TTL)
+_query_cache_lock = threading.RLock()
+
+# Resolved assistant handles, keyed by assistant name
+_assistants: Dict[str, object] = {}
+
+# Identical questions already being answered share one assistant call
+_inflight_queries: Dict[tuple, asyncio.Task] = {}
+
+# Cap concurrent Pinecone calls so bursts stay under the rate limit. Stream
+# openings count against this cap too, but streams use the plugin's own
+# requests call and get no 429/503 backoff
+PINECONE_MAX_CONCURRENCY = int(os.getenv("PINECONE_MAX_CONCURRENCY", "32"))
+_pinecone_semaphore = asyncio.Semaphore(PINECONE_MAX_CONCURRENCY)
+
+# Streams hold this slot for a whole generation but a shared slot only while
+# opening, so they can't starve /query and /assistant/context of call slots
+PINECONE_MAX_STREAMS = int(os.getenv("PINECONE_MAX_STREAMS", "8"))
+_stream_semaphore = asyncio.Semaphore(PINECONE_MAX_STREAMS)
+RETRYABLE_STATUS_CODES = (429, 503)
+
+# Snippets whose simhashes differ in at most this many bits count as duplicates
+SIMHASH_MAX_DISTANCE = 3
+# Spreads the 8 bits of a byte into 8 32-bit counter lanes, so one big-int add
+# per hash byte tallies all of its set bits at once
+_BIT_LANES = [sum((b >> i & 1) << (32 * i) for i in range(8)) for b in range(256)]
+
+# Keep a pooled keep-alive connection per concurrency slot so bursts reuse
+# TLS sessions; the constructor doesn't expose this, and the assistant plugin
+# reads it from the shared config when its clients are built
+pc._openapi_config.connection_pool_maxsize = PINECONE_MAX_CONCURRENCY
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    """True for rate-limit and unavailable errors from the Pinecone SDK"""
+    return getattr(exc, "status", None) in RETRYABLE_STATUS_CODES
+
+
+@retry(
+    retry=retry_if_exception(_is_retryable),
+    wait=wait_exponential(multiplier=0.2, max=4),
+    stop=stop_after_attempt(5),
+    reraise=True
+)
+async def _call_pinecone(func, *args, **kwargs):
+    """Run a blocking Pinecone call in the threadpool, gated by the semaphore"""
+    async with _pinecone_semaphore:
+        return await run_in_threadpool(func, *args, **kwargs)
 
-# Pydantic Models
-class QueryRequest(BaseModel):
+
+async def _get_assistant(name: str):
+    """Return the cached assistant handle, resolving it through Pinecone on a miss"""
+    assistant = _assistants.get(name)
+    if assistant is None:
+        assistant = await _call_pinecone(pc.assistant.Assistant, assistant_name=name)
+        _assistants[name] = assistant
+    return assistant
+
+
+# Request Models
+class QueryRequest(msgspec.Struct, kw_only=True):
     tenant_id: str = "default"  # Tenant ID for future multi-tenancy
     question: str
+    cache_bypass: bool = False  # Skip the answer cache for freshness-sensitive callers
+
+
+_query_decoder = msgspec.json.Decoder(QueryRequest)
+
+# msgspec bypasses FastAPI's body parsing, so document the body explicitly
+(_, ), _query_schemas = msgspec.json.schema_components([QueryRequest])
+QUERY_REQUEST_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": _query_schemas["QueryRequest"]}}
+    }
+}
 
 
+async def _decode_query(request: Request) -> QueryRequest:
+    """Decode and validate the JSON body with msgspec instead of Pydantic"""
+    try:
+        return _query_decoder.decode(await request.body())
+    except msgspec.ValidationError as e:
+        raise RequestValidationError([{"loc": ["body"], "msg": str(e), "type": "value_error"}])
+    except msgspec.DecodeError as e:
+        raise RequestValidationError([{"loc": ["body"], "msg": str(e), "type": "json_invalid"}])
+
+
+# Response Models
 class AssistantResponse(BaseModel):
     answer: str
     citations: List[Dict]
     tenant_id: str
 
 
+def _query_cache_key(tenant_id: str, question: str) -> tuple:
+    """Build the answer cache key from the tenant and normalized question"""
+    normalized = " ".join(question.split()).lower()
+    digest = hashlib.blake2b(normalized.encode(), digest_size=16).hexdigest()
+    return (tenant_id, digest)
+
+
+def _format_citations(citations) -> List[Dict]:
+    """Flatten assistant citations into one entry per referenced file"""
+    formatted = []
+    for citation in citations or ():
+        position = citation.position or 0
+        for ref in citation.references:
+            file = ref.file
+            formatted.append({
+                "file_name": file.name or "Unknown",
+                "file_id": file.id or "",
+                "pages": ref.pages or [],
+                "position": position,
+                "metadata": file.metadata or {}
+            })
+    return formatted
+
+
+def _format_snippets(snippets) -> List[Dict]:
+    """Convert context snippets into plain dicts"""
+    formatted = []
+    for snippet in snippets:
+        reference = snippet.reference
+        file = reference.file
+        formatted.append({
+            "content": snippet.content,
+            "score": snippet.score,
+            "file_name": file.name,
+            "file_id": file.id,
+            # Text, markdown and JSON references carry no page numbers
+            "pages": getattr(reference, "pages", None) or []
+        })
+    return formatted
+
+
+def _simhash(text: str) -> int:
+    """64-bit simhash over lower-cased word 4-gram shingles"""
+    words = re.findall(r"\w+", text.lower())
+    shingle_count = max(len(words) - 3, 1)
+    counters = 0
+    for i in range(shingle_count):
+        shingle = " ".join(words[i:i + 4]).encode()
+        for j, byte in enumerate(hashlib.blake2b(shingle, digest_size=8).digest()):
+            counters += _BIT_LANES[byte] << (256 * j)
+    # A bit is set when it was set in more than half of the shingles
+    return sum(
+        1 << bit for bit in range(64)
+        if (counters >> (32 * bit) & 0xFFFFFFFF) * 2 > shingle_count
+    )
+
+
+def _dedupe_snippets(snippets: List[Dict]) -> List[Dict]:
+    """Drop near-duplicate text snippets, keeping the highest-scored of each group"""
+    kept = []
+    fingerprints = []
+    for snippet in sorted(snippets, key=lambda s: s["score"] or 0, reverse=True):
+        content = snippet["content"]
+        if isinstance(content, str):
+            fingerprint = _simhash(content)
+            if any(bin(fingerprint ^ seen).count("1") <= SIMHASH_MAX_DISTANCE
+                   for seen in fingerprints):
+                continue
+            fingerprints.append(fingerprint)
+        kept.append(snippet)
+    return kept
+
+
 # API Endpoints
 
 @app.get("/")
@@ -67,8 +274,9 @@ async def root():
 async def health():
     """Health check"""
     try:
-        # Test connection to Pinecone
-        pc.list_indexes()
+        # Test connection to Pinecone; bypass the semaphore and retries so a
+        # busy worker still answers probes promptly
+        await run_in_threadpool(pc.list_indexes)
         return {
             "service": "healthy",
             "pinecone_connected": True,
@@ -76,6 +284,7 @@ async def health():
             "status": "ready"
         }
     except Exception as e:
+        logger.warning("Pinecone health check failed: %s", e)
         return {
             "service": "healthy",
             "pinecone_connected": False,
@@ -84,58 +293,138 @@ async def health():
         }
 
 
-@app.post("/query")
-async def query_assistant(request: QueryRequest):
+async def _ask_assistant(request: QueryRequest, cache_key: tuple) -> Dict:
+    """Send the question to the assistant and cache the formatted answer"""
+    assistant = await _get_assistant(ASSISTANT_NAME)
+
+    # Create message
+    message = Message(role="user", content=request.question)
+
+    # Get response from assistant
+    response = await _call_pinecone(assistant.chat, messages=[message])
+
+    # Plain dict matching AssistantResponse, encoded straight to JSON by orjson
+    result = {
+        "answer": response.message.content,
+        "citations": _format_citations(getattr(response, "citations", None)),
+        "tenant_id": request.tenant_id
+    }
+    with _query_cache_lock:
+        _query_cache[cache_key] = result
+    return result
+
+
+@app.post(
+    "/query",
+    responses={200: {"model": AssistantResponse}},
+    openapi_extra=QUERY_REQUEST_BODY
+)
+async def query_assistant(request: QueryRequest = Depends(_decode_query)):
     """
     Query the Pinecone Assistant
 
     Args:
         tenant_id: User/organization ID (currently unused, kept for future multi-tenancy)
         question: User's question
+        cache_bypass: Skip the answer cache and always query the assistant
     """
+    cache_key = _query_cache_key(request.tenant_id, request.question)
+    if not request.cache_bypass:
+        with _query_cache_lock:
+            cached = _query_cache.get(cache_key)
+        if cached is not None:
+            return ORJSONResponse(cached)
+
     try:
-        # Get assistant instance
-        from pinecone_plugins.assistant.models.chat import Message
-
-        # Initialize assistant
-        assistant = pc.assistant.Assistant(assistant_name=ASSISTANT_NAME)
-
-        # Create message
-        message = Message(role="user", content=request.question)
-
-        # Get response from assistant
-        response = assistant.chat(messages=[message])
-
-        # Format citations
-        citations = []
-        if hasattr(response, 'citations') and response.citations:
-            for citation in response.citations:
-                references = citation.get('references', [])
-                for ref in references:
-                    citations.append({
-                        "file_name": ref.get("file.name", "Unknown"),
-                        "file_id": ref.get("file.id", ""),
-                        "pages": ref.get("pages", []),
-                        "position": citation.get("position", 0),
-                        "metadata": ref.get("metadata", {})
-                    })
-
-        return AssistantResponse(
-            answer=response.message.content,
-            citations=citations,
-            tenant_id=request.tenant_id
-        )
+        if request.cache_bypass:
+            return ORJSONResponse(await _ask_assistant(request, cache_key))
+
+        # Join an identical in-flight query instead of issuing another chat
+        task = _inflight_queries.get(cache_key)
+        if task is None:
+            task = asyncio.ensure_future(_ask_assistant(request, cache_key))
+            _inflight_queries[cache_key] = task
+            task.add_done_callback(lambda _: _inflight_queries.pop(cache_key, None))
+
+        # Shield so one disconnecting client doesn't cancel the shared call
+        return ORJSONResponse(await asyncio.shield(task))
 
     except Exception as e:
+        logger.exception("Assistant query failed")
         raise HTTPException(status_code=500, detail=f"Assistant error: {str(e)}")
 
 
+def _sse_event(payload: Dict) -> str:
+    """Encode a payload as a server-sent event"""
+    return f"data: {orjson.dumps(payload).decode()}\n\n"
+
+
+def _stream_answer(assistant, request: QueryRequest):
+    """Relay assistant tokens as SSE events, finishing with the citations"""
+    message = Message(role="user", content=request.question)
+    citations = []
+    try:
+        for chunk in assistant.chat(messages=[message], stream=True):
+            if chunk is None:
+                continue
+            if chunk.type == "content_chunk":
+                yield _sse_event({"type": "content", "content": chunk.delta.content})
+            elif chunk.type == "citation":
+                citations.extend(_format_citations([chunk.citation]))
+    except Exception as e:
+        logger.exception("Assistant stream failed")
+        yield _sse_event({"type": "error", "detail": f"Assistant error: {str(e)}"})
+        return
+
+    yield _sse_event({
+        "type": "done",
+        "citations": citations,
+        "tenant_id": request.tenant_id
+    })
+
+
+async def _gated_stream(events):
+    """Hold a stream slot for the lifetime of a stream"""
+    async with _stream_semaphore:
+        events = iterate_in_threadpool(events)
+        # Opening the stream is the outbound call, so it also takes a shared
+        # slot until the first event arrives
+        async with _pinecone_semaphore:
+            try:
+                first = await events.__anext__()
+            except StopAsyncIteration:
+                return
+        yield first
+        async for event in events:
+            yield event
+
+
+@app.post("/query/stream", openapi_extra=QUERY_REQUEST_BODY)
+async def query_assistant_stream(request: QueryRequest = Depends(_decode_query)):
+    """
+    Query the Pinecone Assistant and stream the answer as server-sent events
+
+    Emits "content" events as tokens arrive and a final "done" event
+    carrying the citations. Answers are not cached.
+    """
+    try:
+        assistant = await _get_assistant(ASSISTANT_NAME)
+    except Exception as e:
+        logger.exception("Assistant query failed")
+        raise HTTPException(status_code=500, detail=f"Assistant error: {str(e)}")
+
+    return StreamingResponse(
+        _gated_stream(_stream_answer(assistant, request)),
+        media_type="text/event-stream"
+    )
+
+
 @app.get("/assistant/status")
 async def assistant_status():
     """Get assistant status and configuration"""
     try:
         # List assistants to verify ours exists
-        assistants = pc.assistant.list_assistants()
+        assistants = await _call_pinecone(pc.assistant.list_assistants)
 
         # Find our assistant
         our_assistant = None
@@ -161,42 +450,49 @@ async def assistant_status():
         }
 
     except Exception as e:
+        logger.exception("Assistant status check failed")
         raise HTTPException(status_code=500, detail=f"Status check failed: {str(e)}")
 
 
-@app.get("/assistant/context")
-async def get_context(request: QueryRequest):
+@app.get("/assistant/context", openapi_extra=QUERY_REQUEST_BODY)
+async def get_context(
+    request: QueryRequest = Depends(_decode_query),
+    top_k: int = Query(5, ge=1, le=20),
+    snippet_size: int = Query(1024, ge=512, le=8192)
+):
     """
     Get relevant context snippets without generating a full response
     Useful for debugging or custom RAG implementations
+
+    Args:
+        top_k: Maximum number of snippets to retrieve, before near-duplicate
+            removal; the response may hold fewer
+        snippet_size: Maximum snippet size in tokens, truncated by Pinecone
+            before the snippets reach this server
     """
     try:
-        assistant = pc.assistant.Assistant(assistant_name=ASSISTANT_NAME)
+        assistant = await _get_assistant(ASSISTANT_NAME)
 
-        response = assistant.context(
+        response = await _call_pinecone(
+            assistant.context,
             query=request.question,
-            top_k=5,
-            snippet_size=1024
+            top_k=top_k,
+            snippet_size=snippet_size
         )
 
-        # Format context snippets
-        snippets = []
-        for snippet in response.snippets:
-            snippets.append({
-                "content": snippet.content,
-                "score": snippet.score,
-                "file_name": snippet.reference.file.name,
-                "file_id": snippet.reference.file.id,
-                "pages": snippet.reference.pages
-            })
+        # Fingerprinting is CPU work; keep it off the event loop
+        snippets = await run_in_threadpool(
+            lambda: _dedupe_snippets(_format_snippets(response.snippets))
+        )
 
-        return {
+        return ORJSONResponse({
             "query": request.question,
             "snippets": snippets,
             "tenant_id": request.tenant_id
-        }
+        })
 
     except Exception as e:
+        logger.exception("Context retrieval failed")
         raise HTTPException(status_code=500, detail=f"Context retrieval failed: {str(e)}")
 
 